@@ -11,14 +11,46 @@ import sqlite3
 import traceback
 import signal
 import sys
+import threading
+import queue
+import time
+import importlib.util
 from argparse import ArgumentParser
-from smtplib import SMTP
+from collections import deque
+from itertools import islice
+from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
+from smtplib import SMTP, SMTPException
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 try:
     from configparser import ConfigParser
 except ImportError:
     from ConfigParser import ConfigParser
-from git import Repo, Remote
-from git.exc import GitCommandError
+# Use the fastest JSON parser installed. simdjson.loads (unlike its Parser)
+# returns plain dicts and lists like the rest, and all of them take bytes.
+try:
+    from simdjson import loads as json_loads
+except ImportError:
+    try:
+        from orjson import loads as json_loads
+    except ImportError:
+        try:
+            from ujson import loads as json_loads
+        except ImportError:
+            from json import loads as json_loads
+try:
+    import ijson
+except ImportError:
+    ijson = None
+# httpx only speaks HTTP/2 with h2 installed, and without that requests is
+# just as good.
+try:
+    import httpx
+    if importlib.util.find_spec( 'h2' ) is None:
+        httpx = None
+except ImportError:
+    httpx = None
 
 class GitBackupFailedException( Exception ):
     def __init__( self, repo_dir, op ):
@@ -27,340 +59,1112 @@ class GitBackupFailedException( Exception ):
         self.repo_dir = repo_dir
         self.op = op
 
+# Picks the only two rels _get_paged cares about out of a Link header.
+LINK_RE = re.compile( r'<([^>]+)>;\s*rel="(next|last)"' )
+
+# The only fields of a listed repo or gist that a backup looks at.
+LISTING_FIELDS = ('id', 'name', 'size', 'topics', 'git_url', 'git_pull_url',
+    'pushed_at', 'updated_at')
+
+def _slim_listing( item ):
+
+    ''' Copy just the fields in LISTING_FIELDS (and the owner login) out of a
+    repo or gist from an API listing, so the rest of the decoded page can be
+    freed instead of being carried around for the whole backup. '''
+
+    slim = {key: item[key] for key in LISTING_FIELDS if key in item}
+    slim['owner'] = {'login': item['owner']['login']}
+    return slim
+
+def _page_urls( next_url, last_url ):
+
+    ''' Given the next and last links from a paged API response, return the
+    URLs of every remaining page, or None if the links aren't page-numbered
+    (in which case they must be followed one at a time). '''
+
+    if not next_url or not last_url:
+        return None
+
+    next_parts = urlparse( next_url )
+    query = parse_qs( next_parts.query )
+    last_query = parse_qs( urlparse( last_url ).query )
+    if 'page' not in query or 'page' not in last_query:
+        return None
+
+    urls = []
+    first_page = int( query['page'][0] )
+    last_page = int( last_query['page'][0] )
+    for page in range( first_page, last_page + 1 ):
+        query['page'] = [str( page )]
+        urls.append( urlunparse(
+            next_parts._replace( query=urlencode( query, doseq=True ) ) ) )
+    return urls
+
+GRAPHQL_URL = 'https://api.github.com/graphql'
+
+# Start waiting for the rate limit to reset with this many requests left,
+# since several workers may be mid-request when the quota runs out.
+RATE_LIMIT_FLOOR = 10
+
+# How many times to wait out the rate limit and retry a refused request.
+RATE_LIMIT_RETRIES = 3
+
+# Responses that mean GitHub had a hiccup and the request may be retried,
+# and how many times to, backing off RETRY_BACKOFF * 2^n seconds in between.
+RETRY_STATUSES = (429, 502, 503, 504)
+RETRY_TOTAL = 5
+RETRY_BACKOFF = 0.5
+
+# The LISTING_FIELDS of a Repository, as read by _graphql_listing.
+REPOSITORY_FRAGMENT = '''
+fragment listing on Repository {
+    databaseId
+    name
+    diskUsage
+    url
+    pushedAt
+    owner { login }
+    repositoryTopics( first: 20 ) { nodes { topic { name } } }
+}
+'''
+
+# A user's starred repos, 100 at a time.
+STARRED_QUERY = '''
+query( $login: String!, $cursor: String ) {
+    user( login: $login ) {
+        starredRepositories( first: 100, after: $cursor ) {
+            pageInfo { endCursor hasNextPage }
+            nodes { ...listing }
+        }
+    }
+}
+''' + REPOSITORY_FRAGMENT
+
+# The same repos the REST user/repos lists for the authenticated user.
+USER_REPOS_QUERY = '''
+query( $cursor: String ) {
+    viewer {
+        repositories( first: 100, after: $cursor,
+            affiliations: [OWNER, COLLABORATOR, ORGANIZATION_MEMBER],
+            ownerAffiliations: [OWNER, COLLABORATOR, ORGANIZATION_MEMBER] ) {
+            pageInfo { endCursor hasNextPage }
+            nodes { ...listing }
+        }
+    }
+}
+''' + REPOSITORY_FRAGMENT
+
+def _graphql_listing( node ):
+
+    ''' Translate a GraphQL Repository node into the same shape as a slimmed
+    REST listing item, so GitHubRepo doesn't have to care where it came
+    from. '''
+
+    return {
+        'id': node['databaseId'],
+        'name': node['name'],
+        'size': node['diskUsage'] or 0,
+        'git_url': '{}.git'.format( node['url'] ),
+        'pushed_at': node['pushedAt'],
+        'topics': [t['topic']['name']
+            for t in node['repositoryTopics']['nodes']],
+        'owner': {'login': node['owner']['login']} }
+
+def _load_json_file( path ):
+
+    ''' Load a JSON cache file, treating a missing or damaged one as
+    empty. '''
+
+    try:
+        with open( path, 'rb' ) as json_file:
+            return json_loads( json_file.read() )
+    except (IOError, ValueError) as e:
+        logging.getLogger( 'cache' ).debug(
+            'not using cache %s: %s', path, e )
+        return {}
+
+def _save_json_file( path, data ):
+
+    # Write to a temp file and move it into place so an interrupted run
+    # can't leave half a cache behind.
+    temp_path = '{}.tmp'.format( path )
+    with open( temp_path, 'w' ) as json_file:
+        json.dump( data, json_file )
+    os.replace( temp_path, path )
+
+class GitHubAPIException( Exception ):
+    pass
+
 class GitHubRepo( object ):
 
-    def __init__( self, repo_json, topic_filter=None, max_size=None ):
+    # The fields every backup reads get slots; anything else in the listing
+    # is looked up in _repo by __getattr__ when asked for.
+    __slots__ = ('_repo', 'owner', 'id', 'size', 'pushed_at', 'updated_at')
+
+    logger = logging.getLogger( 'github.repo' )
+
+    def __init__( self, repo_json ):
         self._repo = repo_json
-        self.topic_filter = topic_filter
-        self.max_size = max_size
-        for key in repo_json:
-            setattr( self, key, repo_json[key] )
         self.owner = repo_json['owner']['login']
-        self.logger = logging.getLogger( 'github.repo' )
+        self.id = repo_json['id']
+        self.size = repo_json.get( 'size' )
+        self.pushed_at = repo_json.get( 'pushed_at' )
+        self.updated_at = repo_json.get( 'updated_at' )
+
+    def __getattr__( self, name ):
+        # Only called for names that aren't slots; don't recurse if _repo
+        # itself hasn't been set yet.
+        if '_repo' == name:
+            raise AttributeError( name )
+        try:
+            return self._repo[name]
+        except KeyError:
+            raise AttributeError( name )
 
-    def backup( self, local ):
+    @property
+    def local_name( self ):
 
-        working_repo_path = os.path.join( self.owner, self.name )
+        ''' The name the backup is kept under in its owner's dir. '''
 
-        # If a topic arg was specified, only backup repos with that topic.
-        if self.topic_filter and \
-        ('topics' not in repo or self.topic_filter not in self.topics):
-            return False
+        return self.name
 
-        self.logger.info( '{} ({})'.format( working_repo_path, self.id ) )
-        self.logger.info( 'repo size: {}'.format( self.size / 1024 ) )
+    def backup( self, local, watcher=None ):
 
-        # Make sure the repo isn't too big.
-        if self.max_size and self.max_size <= (self.size / 1024):
-            self.logger.warning(
-                'skipping repo {} larger than {} ({})'.format(
-                working_repo_path, max_size, self.size ) )
-            return False
+        working_repo_path = os.path.join( self.owner, self.name )
+
+        self.logger.info( '%s (%s)', working_repo_path, self.id )
+        # GitHub reports sizes in KB; log them as-is so a filtered-out call
+        # costs nothing.
+        self.logger.info( 'repo size: %s KB', self.size )
 
-        # Make sure owner directory exists.
-        owner_path = os.path.join( local.get_root(), self.owner )
-        if not os.path.exists( owner_path ):
+        # Nothing to fetch if nobody has pushed since the last backup.
+        if local.is_current( self.name, self.owner, self.pushed_at ):
             self.logger.info(
-                'creating owner path for {}'.format( self.owner ) )
-            os.mkdir( owner_path )
+                'repo %s unchanged since last backup', working_repo_path )
+            return False
 
-        local.create_or_update( self.name, self.git_url, self.owner )
-        local.update_metadata( self )
+        changed = local.create_or_update(
+            self.name, self.git_url, self.owner, watcher )
+        local.mark_current( self.name, self.owner, self.pushed_at )
+        local.queue_metadata( self )
+        return changed
 
 class GitHubGist( GitHubRepo ):
 
-    def backup( self, local ):
+    __slots__ = ()
+
+    @property
+    def local_name( self ):
+        return self.id
+
+    def backup( self, local, watcher=None ):
 
         owner_gist_path = os.path.join( self.owner, self.id )
-        self.logger.info( '{}'.format( owner_gist_path ) )
+        self.logger.info( '%s', owner_gist_path )
 
-        # Make sure owner directory exists.
-        owner_path = os.path.join( local.get_root(), self.owner )
-        if not os.path.exists( owner_path ):
-            logger.info(
-                'creating owner path for {}'.format( self.owner ) )
-            os.mkdir( owner_path )
+        # Gists aren't pushed to in the same sense, but any change to one
+        # bumps its updated_at.
+        if local.is_current( self.id, self.owner, self.updated_at ):
+            self.logger.info(
+                'gist %s unchanged since last backup', owner_gist_path )
+            return False
 
-        local.create_or_update( self.id, self.git_pull_url, self.owner )
-        local.update_metadata( self )
+        changed = local.create_or_update(
+            self.id, self.git_pull_url, self.owner, watcher )
+        local.mark_current( self.id, self.owner, self.updated_at )
+        local.queue_metadata( self )
+        return changed
 
 class GitHub( object ):
 
-    def __init__( self, username, token, topic_filter, max_size, skip_repos ):
+    def __init__( self, username, token, topic_filter, max_size, skip_repos,
+        page_jobs=10, etag_path=None ):
 
         self.logger = logging.getLogger( 'github' )
         self.username = username
+        # Topics are part of the stable media type now; no preview needed.
         self.headers = { 'Authorization': 'token {}'.format( token ),
-            'Accept': 'application/vnd.github.mercy-preview+json' }
+            'Accept': 'application/vnd.github+json' }
         self.topic_filter = topic_filter
         self.max_size = max_size
         self.skip_repos = skip_repos
+        self.page_jobs = page_jobs
+        self._etag_path = etag_path
+        self._etags = _load_json_file( etag_path ) if etag_path else {}
+        # When each rate limit resource (core, graphql...) may be used again.
+        self._resume_at = {}
+        self._quota_lock = threading.Lock()
+        # The methods _request retries itself after a hiccup; the requests
+        # adapter's Retry only covers idempotent ones.
+        self._own_retries = ('POST',)
+
+        if httpx is not None:
+            # HTTP/2 multiplexes the concurrent page fetches over a single
+            # connection and handshake. Its transport only retries failed
+            # connects, so _request retries the hiccups for every method.
+            self.session = httpx.Client( headers=self.headers, timeout=30.0,
+                follow_redirects=True,
+                transport=httpx.HTTPTransport( http2=True, retries=3 ) )
+            self._own_retries = ('GET', 'POST')
+        else:
+            # Reuse connections across pages rather than handshaking every
+            # call, and back off when GitHub rate limits us or has a hiccup.
+            self.session = requests.Session()
+            self.session.headers.update( self.headers )
+            adapter = HTTPAdapter( pool_connections=16, pool_maxsize=16,
+                max_retries=Retry( total=RETRY_TOTAL,
+                    backoff_factor=RETRY_BACKOFF,
+                    status_forcelist=RETRY_STATUSES ) )
+            self.session.mount( 'https://', adapter )
+
+    def _call_api( self, path, relative=True, listing=False ):
+
+        ''' GET path from the API. If listing is set, the response is a page
+        of repos or gists, which are slimmed down with _slim_listing and,
+        with ijson available, parsed as they arrive. '''
 
-    def _call_api( self, path, relative=True ):
-        
         if relative:
             path = 'https://api.github.com/{}'.format( path )
 
-        # Get the API response and decode it from JSON.
-        self.logger.info( 'calling {}'.format( path ) )
-        r = requests.get( path, headers=self.headers )
+        if listing and 'per_page=' not in path:
+            # Ask for the biggest pages GitHub allows; the next/last links it
+            # hands back carry this along.
+            path = '{}{}per_page=100'.format( path, '&' if '?' in path else '?' )
+
+        # If we've seen this URL before, GitHub can tell us it hasn't
+        # changed instead of sending (and charging us for) it all again.
+        headers = {}
+        cached = self._etags.get( path )
+        if cached:
+            headers['If-None-Match'] = cached['etag']
 
+        # Get the API response and decode it from JSON.
+        self.logger.info( 'calling %s', path )
+        # Streaming is only wired up for requests' file-like r.raw.
+        stream = listing and ijson is not None and httpx is None
+        if stream:
+            r = self._request( 'GET', path, 'core', headers=headers,
+                stream=True )
+        else:
+            r = self._request( 'GET', path, 'core', headers=headers )
         # Parse links if available.
-        if 'link' in r.headers:
-            rel_links = requests.utils.parse_header_links( r.headers['link'] )
-            for link in rel_links:
-                if 'next' == link['rel']:
-                    return {'json': r.json(), 'next': link['url']}
+        links = {'next': None, 'last': None}
+        for url, rel in LINK_RE.findall( r.headers.get( 'link', '' ) ):
+            links[rel] = url
+
+        if cached and 304 == r.status_code:
+            r.close()
+            self.logger.debug( '%s not modified', path )
+            # The ETag only covers this page; if the listing grew or shrank,
+            # only the fresh links say so.
+            cached['response'] = dict( cached['response'], **links )
+            return cached['response']
+
+        # Don't mistake an error (a bad token, a missing user...) for an
+        # empty page.
+        if 200 != r.status_code:
+            message = r.text
+            r.close()
+            raise GitHubAPIException( '{} returned {}: {}'.format(
+                path, r.status_code, message ) )
+
+        response = {'next': links['next'], 'last': links['last']}
+        if stream:
+            response['json'] = self._stream_listing( r, path, response )
+            return response
+
+        response['json'] = json_loads( r.content )
+        if listing:
+            response['json'] = \
+                [_slim_listing( item ) for item in response['json']]
+        self._cache_response( r, path, response )
+        return response
+
+    def _request( self, method, url, resource, **kwargs ):
+
+        ''' Send a request, waiting out the rate limit for resource and
+        retrying it if refused, as well as retrying the hiccups the session
+        leaves to us. '''
+
+        refusals = 0
+        hiccups = 0
+        while True:
+            self._wait_for_quota( resource )
+            r = self.session.request( method, url, **kwargs )
+            if self._track_quota( r, resource ):
+                refusals += 1
+                if RATE_LIMIT_RETRIES <= refusals:
+                    r.close()
+                    raise GitHubAPIException(
+                        '{} still rate limited after {} tries'.format(
+                            url, refusals ) )
+            elif r.status_code in RETRY_STATUSES and \
+            method in self._own_retries and RETRY_TOTAL > hiccups:
+                time.sleep( RETRY_BACKOFF * 2 ** hiccups )
+                hiccups += 1
+            else:
+                return r
+            r.close()
+
+    def _wait_for_quota( self, resource ):
+
+        ''' Sleep until GitHub said resource can be used again, if it's run
+        out. '''
+
+        with self._quota_lock:
+            delay = self._resume_at.get( resource, 0 ) - time.time()
+        if 0 < delay:
+            self.logger.warning(
+                '%s rate limit reached; waiting %.1f seconds', resource, delay )
+            time.sleep( delay )
 
-        return {'json': r.json(), 'next': None}
+    def _track_quota( self, r, resource ):
 
-    def get_user( self, username ):
-        res = self._call_api( 'users/{}'.format( username ) )['json']
-        self.logger.debug( res )
-        return res
+        ''' Note when the headers of r say to back off from resource, and
+        return True if r itself was refused because of the rate limit. '''
 
-    def _get_paged( self, response ):
-        for repo in response['json']:
-            yield repo
-        while None != response['next']:
-            response = self._call_api( response['next'], relative=False )
-            for repo in response['json']:
+        retry_after = r.headers.get( 'retry-after' )
+        remaining = r.headers.get( 'x-ratelimit-remaining' )
+        resume = 0
+        if retry_after:
+            resume = time.time() + int( retry_after )
+        elif remaining is not None and RATE_LIMIT_FLOOR >= int( remaining ):
+            resume = int( r.headers.get( 'x-ratelimit-reset', 0 ) )
+
+        if resume:
+            with self._quota_lock:
+                self._resume_at[resource] = \
+                    max( resume, self._resume_at.get( resource, 0 ) )
+
+        return r.status_code in (403, 429) and \
+            bool( retry_after or '0' == remaining )
+
+    def _stream_listing( self, r, path, response ):
+
+        # Hand out each item as soon as it's parsed, so the first clone can
+        # start before the rest of the page has even downloaded.
+        items = []
+        r.raw.decode_content = True
+        try:
+            for item in ijson.items( r.raw, 'item', use_float=True ):
+                items.append( _slim_listing( item ) )
+                yield items[-1]
+        finally:
+            r.close()
+
+        # Only cache pages that were read all the way through.
+        self._cache_response( r, path, dict( response, json=items ) )
+
+    def _cache_response( self, r, path, response ):
+        if 200 == r.status_code and 'etag' in r.headers:
+            self._etags[path] = \
+                {'etag': r.headers['etag'], 'response': response}
+
+    def save_etags( self ):
+        if self._etag_path:
+            os.makedirs( os.path.dirname( self._etag_path ), exist_ok=True )
+            _save_json_file( self._etag_path, self._etags )
+
+    def graphql( self, query, **variables ):
+
+        ''' Run query, returning its data. Any failure, down to a gateway
+        error page, raises GitHubAPIException so callers can fall back to
+        REST. '''
+
+        self.logger.info( 'calling %s', GRAPHQL_URL )
+        r = self._request( 'POST', GRAPHQL_URL, 'graphql',
+            json={'query': query, 'variables': variables} )
+        if 200 != r.status_code:
+            raise GitHubAPIException( '{} returned {}: {}'.format(
+                GRAPHQL_URL, r.status_code, r.text ) )
+        try:
+            res = json_loads( r.content )
+        except ValueError as e:
+            raise GitHubAPIException( '{} returned bad JSON: {}'.format(
+                GRAPHQL_URL, e ) )
+        if 'errors' in res or not res.get( 'data' ):
+            raise GitHubAPIException(
+                res.get( 'errors', res.get( 'message' ) ) )
+        return res['data']
+
+    def _get_graphql_paged( self, query, connection, **variables ):
+
+        ''' Walk the paged connection found by following the keys in
+        connection down from the query's data, yielding its nodes. The first
+        page is requested right away so a failing query raises here rather
+        than partway through iteration. '''
+
+        def get_page( cursor ):
+            page = self.graphql( query, cursor=cursor, **variables )
+            for key in connection:
+                if not page:
+                    raise GitHubAPIException( 'no {} in result'.format( key ) )
+                page = page[key]
+            return page
+
+        def walk( page ):
+            # Fetch the next page while this one's nodes are being used.
+            with ThreadPoolExecutor( max_workers=1 ) as executor:
+                while True:
+                    upcoming = None
+                    if page['pageInfo']['hasNextPage']:
+                        upcoming = executor.submit(
+                            get_page, page['pageInfo']['endCursor'] )
+                    for node in page['nodes']:
+                        yield node
+                    if upcoming is None:
+                        return
+                    page = upcoming.result()
+
+        return walk( get_page( None ) )
+
+    def _wanted( self, repo ):
+
+        ''' Return False if the topic or size filters exclude repo, a slim
+        listing item. '''
+
+        # If a topic arg was specified, only backup repos with that topic.
+        if self.topic_filter and \
+        self.topic_filter not in repo.get( 'topics', () ):
+            return False
+
+        # Make sure the repo isn't too big.
+        if self.max_size and self.max_size <= (repo['size'] / 1024):
+            self.logger.warning( 'skipping repo %s/%s larger than %s (%s)',
+                repo['owner']['login'], repo['name'], self.max_size,
+                repo['size'] )
+            return False
+
+        return True
+
+    def _get_paged( self, path, predicate=None ):
+
+        ''' Yield the items of the listing at path, page by page, leaving out
+        any that predicate (if given) returns False for. '''
+
+        # Don't hold on to the first page here once _iter_pages moves on.
+        for repo in self._iter_pages( self._call_api( path, listing=True ) ):
+            if predicate is None or predicate( repo ):
                 yield repo
 
+    def _iter_pages( self, response ):
+
+        def get_page( url ):
+            return self._call_api( url, relative=False, listing=True )
+
+        # If GitHub told us where the last page is, fetch the rest at once
+        # instead of waiting on each page to find the next one.
+        page_urls = _page_urls( response['next'], response['last'] )
+        if page_urls:
+            # Only ask for page_jobs pages ahead of the one being read. A
+            # streamed page is handed back once its headers are in, so the
+            # pool alone wouldn't stop every page being requested at once.
+            page_urls = iter( page_urls )
+            with ThreadPoolExecutor( max_workers=self.page_jobs ) as executor:
+                upcoming = deque( executor.submit( get_page, url )
+                    for url in islice( page_urls, self.page_jobs ) )
+                for repo in response['json']:
+                    yield repo
+                while upcoming:
+                    response = upcoming.popleft().result()
+                    for url in islice( page_urls, 1 ):
+                        upcoming.append( executor.submit( get_page, url ) )
+                    for repo in response['json']:
+                        yield repo
+            return
+
+        # Otherwise each page only links to the next, but that can still
+        # download while this one is being backed up.
+        with ThreadPoolExecutor( max_workers=1 ) as executor:
+            while True:
+                upcoming = None
+                if None != response['next']:
+                    upcoming = executor.submit( get_page, response['next'] )
+                for repo in response['json']:
+                    yield repo
+                if upcoming is None:
+                    return
+                response = upcoming.result()
+
+    def _get_repos( self, query, connection, rest_path, **variables ):
+
+        ''' Yield the wanted repos from the GraphQL query, which gets us only
+        the fields we need, 100 repos per request. If the query fails, fall
+        back to the REST listing at rest_path. '''
+
+        try:
+            nodes = self._get_graphql_paged( query, connection, **variables )
+        except GitHubAPIException as e:
+            self.logger.warning(
+                'graphql failed, falling back to REST: %s', e )
+        else:
+            for node in nodes:
+                repo = _graphql_listing( node )
+                if self._wanted( repo ):
+                    yield repo
+            return
+
+        for repo in self._get_paged( rest_path, self._wanted ):
+            yield repo
+
     def get_starred_repos( self, username ):
-        user = self.get_user( username )
-        stars_url = re.sub( r'{.*}', '', user['starred_url'] )
-        response = self._call_api( stars_url, relative=False )
-        for repo in self._get_paged( response ):
-            yield GitHubRepo( repo, self.topic_filter, self.max_size )
+        for repo in self._get_repos( STARRED_QUERY,
+            ('user', 'starredRepositories'),
+            'users/{}/starred'.format( username ), login=username
+        ):
+            yield GitHubRepo( repo )
 
     def get_own_user_repos( self ):
-        response = self._call_api( 'user/repos' )
-        for repo in self._get_paged( response ):
+        # List them all and let _wanted check the topic; a topic search
+        # would miss repos the user only collaborates on, and stop at 1000.
+        for repo in self._get_repos(
+            USER_REPOS_QUERY, ('viewer', 'repositories'), 'user/repos'
+        ):
             repo_full = '{}/{}'.format( repo['owner']['login'], repo['name'] )
             if repo_full in self.skip_repos:
                 self.logger.info( 'skipping repo %s...', repo_full )
                 continue
             
-            yield GitHubRepo( repo, self.topic_filter, self.max_size )
+            yield GitHubRepo( repo )
 
     def get_own_starred_gists( self ):
-        response = self._call_api( 'gists/starred' )
-        for gist in self._get_paged( response ):
-            yield GitHubGist( gist, self.topic_filter, self.max_size )
+        for gist in self._get_paged( 'gists/starred' ):
+            yield GitHubGist( gist )
 
     def get_user_gists( self, username ):
-        user = self.get_user( username )
-        response = self._call_api( 'users/{}/gists'.format( username ) )
-        for gist in self._get_paged( response ):
-            yield GitHubGist( gist, self.topic_filter, self.max_size )
+        for gist in self._get_paged( 'users/{}/gists'.format( username ) ):
+            yield GitHubGist( gist )
+
+# How many repos' metadata to write to the DB in each transaction.
+METADATA_BATCH = 100
+
+# Keeps one row per repo, however many times it has been backed up.
+METADATA_UPSERT = '''INSERT INTO repos(owner, name, repo_id, topics)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(owner, name) DO UPDATE SET
+        repo_id=excluded.repo_id, topics=excluded.topics'''
+
+# Updates every local branch from its namesake on the remote.
+HEADS_REFSPEC = '+refs/heads/*:refs/heads/*'
 
 class LocalRepo( object ):
 
-    def __init__( self, root, db_conn ):
+    def __init__( self, root, db_conn, fetch_jobs=4, clone_filter=None,
+        clone_depth=None ):
 
         self._root = root
         self._db_conn = db_conn
+        self._fetch_jobs = fetch_jobs
+        self._clone_filter = clone_filter
+        self._clone_depth = clone_depth
+        self._known_owner_dirs = set()
+        self._owner_roots = {}
+        self._cache_path = os.path.join( root, '.gitbacker_cache.json' )
+        self._cache = _load_json_file( self._cache_path )
+        self._db_lock = threading.Lock()
+        self._metadata_buffer = []
         self.logger = logging.getLogger( 'localrepo' )
+        self._existing_repos = self._scan_repos()
 
     def get_root( self ):
         return self._root
 
+    def _scan_repos( self ):
+
+        ''' Return the (owner, repo) of every repo already under the root,
+        read in one pass so each backup doesn't have to stat its own. The
+        owner dirs found are remembered as well. '''
+
+        existing = set()
+        try:
+            with os.scandir( self._root ) as entries:
+                owner_entries = [e for e in entries if e.is_dir()]
+        except OSError:
+            # No root yet, so nothing has been backed up.
+            return existing
+
+        for owner_entry in owner_entries:
+            if owner_entry.name.endswith( '.git' ):
+                # A repo backed up without an owner dir.
+                existing.add( (None, owner_entry.name[:-4]) )
+                continue
+            # No need for ensure_owner_dir to try creating this one.
+            self._known_owner_dirs.add( owner_entry.name )
+            try:
+                with os.scandir( owner_entry.path ) as repo_entries:
+                    for repo_entry in repo_entries:
+                        if repo_entry.name.endswith( '.git' ) and \
+                        repo_entry.is_dir():
+                            existing.add(
+                                (owner_entry.name, repo_entry.name[:-4]) )
+            except OSError as e:
+                self.logger.warning( 'could not scan %s: %s',
+                    owner_entry.path, e )
+        return existing
+
+    def exists( self, repo, owner=None ):
+        return (owner, repo) in self._existing_repos
+
+    def remove( self, repo, owner=None ):
+        self._existing_repos.discard( (owner, repo) )
+        shutil.rmtree( self.get_path( repo, owner ) )
+
+    def is_current( self, repo, owner, pushed_at ):
+
+        ''' Return True if repo was backed up as of pushed_at (as reported
+        by the API) and is still on disk. '''
+
+        if not pushed_at:
+            return False
+        cached = self._cache.get( '{}/{}'.format( owner, repo ) )
+        return bool( cached ) and pushed_at == cached.get( 'pushed_at' ) and \
+            self.exists( repo, owner )
+
+    def mark_current( self, repo, owner, pushed_at ):
+        if pushed_at:
+            self._cache.setdefault( '{}/{}'.format( owner, repo ), {} )[
+                'pushed_at'] = pushed_at
+
+    def rewritten_as( self, repo, owner ):
+
+        ''' Return the [name, email] repo's history was last rewritten to,
+        or None if it hasn't been. '''
+
+        return self._cache.get(
+            '{}/{}'.format( owner, repo ), {} ).get( 'rewritten_as' )
+
+    def mark_rewritten( self, repo, owner, identity ):
+        self._cache.setdefault( '{}/{}'.format( owner, repo ), {} )[
+            'rewritten_as'] = identity
+
+    def save_cache( self ):
+        os.makedirs( self._root, exist_ok=True )
+        _save_json_file( self._cache_path, self._cache )
+
+    def ensure_owner_dir( self, owner ):
+
+        ''' Make sure the directory for owner's repos exists, only touching
+        the filesystem the first time each owner is seen. '''
+
+        if owner in self._known_owner_dirs:
+            return
+
+        # Just try to create it; one syscall, and no window for another
+        # worker to create it between checking and creating.
+        try:
+            os.makedirs( self._owner_root( owner ) )
+            self.logger.info( 'created owner path for %s', owner )
+        except FileExistsError:
+            pass
+        self._known_owner_dirs.add( owner )
+
+    def _owner_root( self, owner ):
+        owner_root = self._owner_roots.get( owner )
+        if owner_root is None:
+            owner_root = os.path.join( self._root, owner )
+            self._owner_roots[owner] = owner_root
+        return owner_root
+
     def get_path( self, repo, owner=None ):
+        # This is called a few times per repo, so skip os.path.join's
+        # checks for the owner part.
         if owner:
-            return os.path.join( self._root, owner, '{}.git'.format( repo ) )
+            return '{}{}{}.git'.format(
+                self._owner_root( owner ), os.sep, repo )
         else:
             return os.path.join( self._root, '{}.git'.format( repo ) )
 
     def fetch_all_branches( self, owner, repo ):
+
+        ''' Fetch every branch of every remote of the local repo. '''
+
         repo_dir = self.get_path( repo, owner )
-        r = Repo( repo_dir )
-        branches = []
-        try:
-            branches = [b.name for b in r.branches]
-        except UnicodeDecodeError as e:
-            self.logger.error( 'could not decode branch name: {}'.format( e ) )
-        for remote in r.remotes:
-            for branch in branches:
-                self.logger.info( 'checking {}/{} branch: {}'.format(
-                    owner, repo, branch ) )
+
+        fetch_args = []
+        # Keep shallow backups shallow, but never pass --depth to a complete
+        # one, which would throw away its history.
+        if self._clone_depth and \
+        os.path.exists( os.path.join( repo_dir, 'shallow' ) ):
+            fetch_args.append( '--depth={}'.format( self._clone_depth ) )
+
+        def fetch_remote( remote ):
+            self.logger.info(
+                'checking %s/%s remote: %s', owner, repo, remote )
+            # Bare clones have no fetch refspec configured, so name one that
+            # updates every branch in a single negotiation with the remote.
+            self.run_git( ['-C', repo_dir, 'fetch'] + fetch_args +
+                [remote, HEADS_REFSPEC] )
+
+        # Fetch each remote at once; a failure means nothing was fetched from
+        # that remote, so pass it up to be retried.
+        with ThreadPoolExecutor( max_workers=self._fetch_jobs ) as executor:
+            futures = [executor.submit( fetch_remote, remote )
+                for remote in self.get_remotes( repo_dir )]
+            errors = []
+            for future in as_completed( futures ):
                 try:
-                    remote.fetch( branch )
-                except Exception as e:
-                    self.logger.error( '{}: {}'.format( repo, e ) )
+                    future.result()
+                except subprocess.CalledProcessError as e:
+                    self.logger.error( '%s: %s', repo,
+                        e.stderr.decode( 'utf-8', 'replace' ).strip() )
+                    errors.append( e )
+            if errors:
+                raise errors[0]
+
+    def run_git( self, args ):
+
+        ''' Run git with args, raising CalledProcessError (with stderr
+        captured) if it fails. Never stop to prompt for credentials. '''
+
+        return subprocess.run( ['git'] + args, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=dict( os.environ, GIT_TERMINAL_PROMPT='0' ) )
+
+    def get_remotes( self, repo_dir ):
+        return self.run_git( ['-C', repo_dir, 'remote'] ).stdout \
+            .decode( 'utf-8' ).split()
 
-    def update_metadata( self, repo ):
+    def has_remotes( self, repo_dir ):
+        return bool( self.get_remotes( repo_dir ) )
+
+    def remove_remotes( self, repo_dir ):
+        for remote in self.get_remotes( repo_dir ):
+            self.run_git( ['-C', repo_dir, 'remote', 'remove', remote] )
+
+    def ref_tips( self, repo_dir ):
+
+        ''' Return the name and commit of every ref in repo_dir, to see if a
+        fetch changed anything. '''
+
+        return self.run_git( ['-C', repo_dir, 'for-each-ref',
+            '--format=%(objectname) %(refname)'] ).stdout
+
+    def clone( self, remote_url, repo_dir ):
+        cmd = ['clone', '--bare']
+        if self._clone_filter:
+            cmd.append( '--filter={}'.format( self._clone_filter ) )
+        if self._clone_depth:
+            # --depth implies --single-branch, but we want every branch.
+            cmd += ['--depth={}'.format( self._clone_depth ),
+                '--no-single-branch']
+        cmd += [remote_url, repo_dir]
+        self.run_git( cmd )
+
+    def queue_metadata( self, repo ):
+
+        ''' Add repo's metadata to the rows waiting to go into the DB, writing
+        them out once there are METADATA_BATCH of them. '''
 
         if not self._db_conn:
             return
 
-        cur = self._db_conn.cursor()
-        cur.execute(
-            'INSERT INTO repos(owner, name, repo_id, topics) ' +
-            'VALUES (?, ?, ?, ?)',
-            (repo.owner, repo.name, repo.id, str( repo.topics )) )
-        self._db_conn.commit()
+        # The buffer and connection are shared between backup workers.
+        with self._db_lock:
+            self._metadata_buffer.append(
+                (repo.owner, repo.local_name, repo.id,
+                    str( getattr( repo, 'topics', [] ) )) )
+            if METADATA_BATCH <= len( self._metadata_buffer ):
+                self._flush_metadata()
+
+    def flush_metadata( self ):
+        if self._db_conn:
+            with self._db_lock:
+                self._flush_metadata()
+
+    def _flush_metadata( self ):
+
+        # Commit the whole batch at once rather than syncing every row.
+        if self._metadata_buffer:
+            self._db_conn.executemany( METADATA_UPSERT, self._metadata_buffer )
+            self._db_conn.commit()
+            self._metadata_buffer = []
+
+    def create_or_update( self, repo, remote_url, owner=None, watcher=None ):
+
+        ''' Clone or fetch the repo, returning True if that added or moved
+        any refs. Failures are retried unless watcher says we're stopping,
+        since the signal has most likely killed git too. Refs that come from upstream this way are no longer
+        rewritten, whichever phase fetched them, so rewritten_as is
+        forgotten. '''
 
-    def create_or_update( self, repo, remote_url, owner=None ):
         repo_dir = self.get_path( repo, owner )
         try_count = 3
+        # So our stored credentials work.
+        remote_url = remote_url.replace( 'git://', 'https://' )
+
+        if owner:
+            self.ensure_owner_dir( owner )
 
-        if not os.path.exists( repo_dir ):
+        if not self.exists( repo, owner ):
             while 0 < try_count:
+                # Never clean up after a clone into a dir we didn't make.
+                created = not os.path.exists( repo_dir )
                 try:
                     self.logger.info( 'creating local repo copy...' )
-                    # So our stored credentials work.
-                    remote_url = remote_url.replace( 'git://', 'https://' )
-                    Repo.clone_from( remote_url, repo_dir, bare=True )
+                    self.clone( remote_url, repo_dir )
                     try_count = 0
-                except GitCommandError as e:
-                    self.logger.error( 'error cloning; retrying...' )
+                except subprocess.CalledProcessError as e:
+                    self.logger.error( 'error cloning; retrying: %s',
+                        e.stderr.decode( 'utf-8', 'replace' ).strip() )
                     try_count -= 1
-                    if os.path.exists( repo_dir ):
-                        logger.debug( 'removing failed clone...' )
+                    if created and os.path.exists( repo_dir ):
+                        self.logger.debug( 'removing failed clone...' )
                         shutil.rmtree( repo_dir )
-                    if 0 >= try_count:
+                    if 0 >= try_count or \
+                    (watcher is not None and not watcher.running):
                         raise GitBackupFailedException( repo_dir, 'clone' )
+            self._existing_repos.add( (owner, repo) )
+            self.mark_rewritten( repo, owner, None )
+            # Just cloned, so there is nothing newer to fetch.
+            return True
+
+        # Rewritten repos have their remotes removed; put origin back so the
+        # rewrite can be redone over the objects we already have.
+        if not self.has_remotes( repo_dir ):
+            self.logger.info( 'restoring origin remote...' )
+            self.run_git( ['-C', repo_dir, 'remote', 'add', 'origin',
+                remote_url] )
+            self.mark_rewritten( repo, owner, None )
 
         self.logger.info( 'checking all remote repo branches...' )
+        old_tips = self.ref_tips( repo_dir )
         try_count = 3
         while 0 < try_count:
             try:
                 self.fetch_all_branches( owner, repo )
                 try_count = 0
-            except GitCommandError as e:
+            except subprocess.CalledProcessError as e:
                 self.logger.error( 'error fetching; retrying...' )
                 try_count -= 1
-                if 0 >= try_count:
+                if 0 >= try_count or \
+                (watcher is not None and not watcher.running):
                     raise GitBackupFailedException( repo_dir, 'fetch' )
 
+        if old_tips == self.ref_tips( repo_dir ):
+            return False
+        self.mark_rewritten( repo, owner, None )
+        return True
+
 class Notifier( object ):
 
     def __init__( self, host, to_addr, from_addr ):
         self.host = host
         self.to_addr = to_addr
         self.from_addr = from_addr
+        self.logger = logging.getLogger( 'notifier' )
+        # Mail goes out from a background thread so backup workers (and
+        # the signal handler) never wait on the SMTP server. SimpleQueue's
+        # put is reentrant, so the handler can't deadlock on a send() it
+        # interrupted.
+        self._outbox = queue.SimpleQueue()
+        self._sender = threading.Thread( target=self._drain, daemon=True )
+        self._sender.start()
 
     def send( self, subject, body ):
 
         msg = ('From {}\r\nTo: {}\r\nSubject: {}\r\n\r\n{}'.format(
             self.from_addr, self.to_addr, subject, body ) )
+        self._outbox.put( msg )
+
+    def _drain( self ):
+
+        # Keep one SMTP connection for the whole run, reconnecting once if
+        # the server has dropped it in between messages.
+        smtp = None
+        while True:
+            msg = self._outbox.get()
+            if msg is None:
+                break
+            for attempt in range( 2 ):
+                try:
+                    if smtp is None:
+                        smtp = SMTP( self.host )
+                    smtp.sendmail( self.from_addr, [self.to_addr], msg )
+                    break
+                except (SMTPException, OSError) as e:
+                    self.logger.error( 'could not send notification: %s', e )
+                    smtp = None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (SMTPException, OSError):
+                pass
 
-        smtp = SMTP( self.host )
-        smtp.sendmail( self.from_addr, [self.to_addr], msg )
-        smtp.quit()
+    def close( self, timeout=30 ):
+
+        ''' Send whatever is still queued, waiting up to timeout seconds. '''
+
+        self._outbox.put( None )
+        self._sender.join( timeout )
 
     def send_exc( self, subject, e ):
 
         self.send( subject, traceback.format_exc() )
 
 class SigWatcher( object ):
+
+    ''' Tells the backup workers to stop when a signal arrives. If force is
+    set, backup_all exits with an error once they have, and what they did
+    is saved; exiting from the handler itself would skip both. '''
+
     def __init__( self, notifier, force=False ):
         self.notifier = notifier
         self.force = force
-        self.running = True
+        # Checked by every backup worker between repos.
+        self._stopped = threading.Event()
+
+    @property
+    def running( self ):
+        return not self._stopped.is_set()
 
     def handle( self, signum, frame ):
+        # Stop the workers first; the notification can take a while.
+        self._stopped.set()
         self.notifier.send(
             '[gitbacker] Received Signal {}'.format( signum ), '' )
-        self.running = False
-        if self.force:
-            sys.exit( 1 )
 
-def debug_print( struct ):
+def backup_parallel( items, backup_item, notifier, label, watcher, jobs ):
+
+    ''' Call backup_item on each of items from a pool of worker threads,
+    since the clone/fetch work is network-bound. Items are fed through a
+    bounded queue as they come off the API, so listing the next page
+    overlaps with the backups and only a few items are in flight at once.
+    An item listed twice is only backed up once. Returns the number of items
+    backed up without error. '''
+
+    logger = logging.getLogger( 'backup' )
+    work = queue.Queue( maxsize=jobs * 4 )
+    stop = object()
+    count_lock = threading.Lock()
+    count = [0]
 
-    from pprint import PrettyPrinter
-    pp = PrettyPrinter()
-    pp.pprint( struct )
+    def worker():
+        while True:
+            item = work.get()
+            try:
+                if item is stop:
+                    return
+                if not watcher.running:
+                    # Drain whatever is left without starting it.
+                    continue
+                backup_item( item )
+                with count_lock:
+                    count[0] += 1
+            except GitBackupFailedException as e:
+                if not watcher.running:
+                    # Cut short by the signal, which was already reported.
+                    logger.warning( 'interrupted %s %s: %s',
+                        label, e.op, e.repo_dir )
+                    continue
+                notifier.send_exc(
+                    '[gitbacker] ERROR during {} {}'.format( label, e.op ),
+                    'repo dir: {}'.format( e.repo_dir ) )
+            except Exception as e:
+                # Don't let one bad repo take a worker down with it.
+                logger.exception( e )
+                notifier.send_exc(
+                    '[gitbacker] ERROR during {}'.format( label ), e )
+            finally:
+                work.task_done()
+
+    workers = [threading.Thread( target=worker ) for i in range( jobs )]
+    for thread in workers:
+        thread.start()
+
+    try:
+        # Pages fetched at once can repeat an item if the listing shifts in
+        # between, and two workers on one repo would clobber each other.
+        seen = set()
+        for item in items:
+            if not watcher.running:
+                break
+            key = (item.owner, item.local_name)
+            if key in seen:
+                continue
+            seen.add( key )
+            work.put( item )
+    finally:
+        for thread in workers:
+            work.put( stop )
+        for thread in workers:
+            thread.join()
 
-def backup_user_repos( git, local, redo, uname, uemail, notifier, watcher ):
+    return count[0]
+
+def backup_user_repos(
+    git, local, redo, uname, uemail, notifier, watcher, jobs ):
 
     ''' Backup all repos for the github user this script is accessing the
     API as, to the directory repo_dir/user_name. '''
 
-    count = 0
     logger = logging.getLogger( 'repos.user' )
-    for repo in git.get_own_user_repos():
 
-        repo_dir = local.get_path( repo.name )
-        if os.path.exists( repo_dir ) and redo:
-            # Remove the repo dir so it can be re-created.
-            shutil.rmtree( repo_dir )
+    # filter-repo rewrites history far faster than filter-branch, which
+    # runs the env filter in a new shell for every commit.
+    have_filter_repo = shutil.which( 'git-filter-repo' )
 
-        try:
-            res = repo.backup( local )
-        except GitBackupFailedException as e:
-            notifier.send_exc(
-                '[gitbacker] ERROR during user repo {}'.format( e.op ),
-                'repo dir: {}'.format( e.repo_dir ) )
-            continue
-
-        # Change author/committer ID information if specified.
-        if res and uname and uemail:
-            cmd = ['git', 'filter-branch', '-f', '--env-filter', "GIT_AUTHOR_NAME='{}'; GIT_AUTHOR_EMAIL='{}'; GIT_COMMITTER_NAME='{}'; GIT_COMMITTER_EMAIL='{}';".format( uname, uemail, uname, uemail ), '--', '--all']
-            proc = subprocess.Popen( cmd, cwd=repo_dir, stdout=subprocess.PIPE )
-
-            git_std = proc.communicate()
-            for line in git_std:
-                if line:
-                    logger.info( '{}: {}'.format( repo.name, line.strip() ) )
+    def backup_repo( repo ):
+
+        repo_dir = local.get_path( repo.name, repo.owner )
+        if redo and local.exists( repo.name, repo.owner ):
+            # Remove the repo dir so it can be re-created.
+            local.remove( repo.name, repo.owner )
+
+        res = repo.backup( local, watcher )
+
+        # Change author/committer ID information if specified, unless the
+        # backup came through unchanged and was already rewritten to the
+        # same identity.
+        if uname and uemail and (res or [uname, uemail] !=
+            local.rewritten_as( repo.name, repo.owner )
+        ):
+            # Any fetched refs are upstream's again, so don't count the repo
+            # as rewritten until this rewrite succeeds.
+            local.mark_rewritten( repo.name, repo.owner, None )
+            if have_filter_repo:
+                # The callbacks are Python; repr() quotes the values safely.
+                cmd = ['git', 'filter-repo', '--force',
+                    '--name-callback',
+                    'return {!r}'.format( uname.encode( 'utf-8' ) ),
+                    '--email-callback',
+                    'return {!r}'.format( uemail.encode( 'utf-8' ) )]
+            else:
+                cmd = ['git', 'filter-branch', '-f', '--env-filter', "GIT_AUTHOR_NAME='{}'; GIT_AUTHOR_EMAIL='{}'; GIT_COMMITTER_NAME='{}'; GIT_COMMITTER_EMAIL='{}';".format( uname, uemail, uname, uemail ), '--', '--all']
+            # filter-branch otherwise stalls for ten seconds on every repo to
+            # warn that it's deprecated.
+            proc = subprocess.run( cmd, cwd=repo_dir, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                env=dict( os.environ, FILTER_BRANCH_SQUELCH_WARNING='1' ) )
+            for line in proc.stdout.decode( 'utf-8', 'replace' ).splitlines():
+                if line.strip():
+                    logger.info( '%s: %s', repo.name, line.strip() )
+
+            # Keep the remotes of a repo we couldn't rewrite, so the rewrite
+            # is tried again next run.
+            if 0 != proc.returncode:
+                raise GitBackupFailedException( repo_dir, 'rewrite' )
 
             # Prune all remotes to sterilize.
-            r = Repo( repo_dir )
-            for remote in r.remotes:
-                Remote.remove( r, remote.name )
+            local.remove_remotes( repo_dir )
+            local.mark_rewritten( repo.name, repo.owner, [uname, uemail] )
 
-        count += 1
+    return backup_parallel( git.get_own_user_repos(), backup_repo, notifier,
+        'user repo', watcher, jobs )
 
-        if not watcher.running:
-            return count
+def backup_starred_repos( git, local, username, notifier, watcher, jobs ):
+    return backup_parallel( git.get_starred_repos( username ),
+        lambda repo: repo.backup( local, watcher ), notifier, 'starred repo',
+        watcher, jobs )
 
-    return count
+def backup_user_gists( git, local, username, notifier, watcher, jobs ):
+    return backup_parallel( git.get_user_gists( username ),
+        lambda gist: gist.backup( local, watcher ), notifier, 'user gist',
+        watcher, jobs )
 
-def backup_starred_repos( git, local, username, notifier, watcher ):
-    count = 0
-    logger = logging.getLogger( 'repos.starred' )
-    for repo in git.get_starred_repos( username ):
-        try:
-            repo.backup( local )
-            count += 1
-        except GitBackupFailedException as e:
-            notifier.send_exc(
-                '[gitbacker] ERROR during starred repo {}'.format( e.op ),
-                'repo dir: {}'.format( e.repo_dir ) )
-        if not watcher.running:
-            return count
-    return count
-
-def backup_user_gists( git, local, username, notifier, watcher ):
-    count = 0
-    logger = logging.getLogger( 'gists.user' )
-    for gist in git.get_user_gists( username ):
-        try:
-            gist.backup( local )
-            count += 1
-        except GitBackupFailedException as e:
-            notifier.send_exc(
-                '[gitbacker] ERROR during user gist {}'.format( e.op ),
-                'repo dir: {}'.format( e.repo_dir ) )
-        if not watcher.running:
-            return count
-    return count
-
-def backup_starred_gists( git, local, notifier, watcher ):
-    count = 0
-    logger = logging.getLogger( 'gists.starred' )
-    for gist in git.get_own_starred_gists():
-        try:
-            gist.backup( local )
-            count += 1
-        except GitBackupFailedException as e:
-            notifier.send_exc(
-                '[gitbacker] ERROR during starred gist {}'.format( e.op ),
-                'repo dir: {}'.format( e.repo_dir ) )
-        if not watcher.running:
-            return count
-    return count
+def backup_starred_gists( git, local, notifier, watcher, jobs ):
+    return backup_parallel( git.get_own_starred_gists(),
+        lambda gist: gist.backup( local, watcher ), notifier, 'starred gist',
+        watcher, jobs )
 
 def backup_all( git, local, username, args, notifier ):
 
@@ -371,61 +1175,82 @@ def backup_all( git, local, username, args, notifier ):
     signal.signal( signal.SIGINT, watcher.handle )
     signal.signal( signal.SIGTERM, watcher.handle )
 
-    if args.name or args.email or args.redo:
+    # Rewriting authors reuses the existing repos; only re-clone when asked.
+    if args.redo:
         logger.info( 'Redo enabled.' )
         redo = True
 
-    if args.starred_repos:
-        try:
-            repos_count += backup_starred_repos(
-                git, local, username, notifier, watcher )
-        except Exception as e:
-            error_cond = True
-            notifier.send_exc( '[gitbacker] ERROR during starred_repos', e )
-            logger.exception( e )
-
-        if not watcher.running:
-            return
-
-    if args.user_repos:
-        try:
-            repos_count += backup_user_repos(
-                git, local, redo, args.name, args.email, notifier, watcher )
-        except Exception as e:
-            error_cond = True
-            notifier.send_exc( '[gitbacker] ERROR during user_repos', e )
-            logger.exception( e )
-
-        if not watcher.running:
-            return
-
-    if args.user_gists:
-        try:
-            repos_count += backup_user_gists(
-                git, local, username, notifier, watcher )
-        except Exception as e:
-            error_cond = True
-            notifier.send_exc( '[gitbacker] ERROR during user_gists', e )
-            logger.exception( e )
-
-        if not watcher.running:
-            return
-
-    if args.starred_gists:
+    try:
+        if args.starred_repos:
+            try:
+                repos_count += backup_starred_repos(
+                    git, local, username, notifier, watcher, args.jobs )
+            except Exception as e:
+                error_cond = True
+                notifier.send_exc(
+                    '[gitbacker] ERROR during starred_repos', e )
+                logger.exception( e )
+
+            if not watcher.running:
+                return
+
+        if args.user_repos:
+            try:
+                repos_count += backup_user_repos(
+                    git, local, redo, args.name, args.email, notifier, watcher,
+                    args.jobs )
+            except Exception as e:
+                error_cond = True
+                notifier.send_exc(
+                    '[gitbacker] ERROR during user_repos', e )
+                logger.exception( e )
+
+            if not watcher.running:
+                return
+
+        if args.user_gists:
+            try:
+                repos_count += backup_user_gists(
+                    git, local, username, notifier, watcher, args.jobs )
+            except Exception as e:
+                error_cond = True
+                notifier.send_exc(
+                    '[gitbacker] ERROR during user_gists', e )
+                logger.exception( e )
+
+            if not watcher.running:
+                return
+
+        if args.starred_gists:
+            try:
+                repos_count += backup_starred_gists(
+                    git, local, notifier, watcher, args.jobs )
+            except Exception as e:
+                error_cond = True
+                notifier.send_exc(
+                    '[gitbacker] ERROR during starred_gists', e )
+                logger.exception( e )
+
+            if not watcher.running:
+                return
+
+        if not error_cond:
+            notifier.send(
+                '[gitbacker] Backed up {} repos OK'.format( repos_count ),
+                'Backed up {} repos OK'.format( repos_count ) )
+    finally:
         try:
-            repos_count += backup_starred_gists( git, local, notifier, watcher )
-        except Exception as e:
-            error_cond = True
-            notifier.send_exc( '[gitbacker] ERROR during starred_gists', e )
-            logger.exception( e )
-
-        if not watcher.running:
-            return
-
-    if not error_cond:
-        notifier.send(
-            '[gitbacker] Backed up {} repos OK'.format( repos_count ),
-            'Backed up {} repos OK'.format( repos_count ) )
+            # Remember what we've backed up even if we were interrupted.
+            local.flush_metadata()
+            local.save_cache()
+            git.save_etags()
+        finally:
+            # Don't exit with notifications still waiting to go out, even
+            # for the error that's on its way up.
+            notifier.close()
+        # The phases return early when stopped, so exit from here.
+        if watcher.force and not watcher.running:
+            sys.exit( 1 )
 
 if '__main__' == __name__:
 
@@ -453,11 +1278,19 @@ if '__main__' == __name__:
     parser.add_argument( '-x', '--redo', action='store_true',
         help='Remove existing repos and re-clone.' )
     parser.add_argument( '-e', '--email', action='store',
-        help='Change the e-mail on commits to downloaded repos (implies -x).' )
+        help='Change the e-mail on commits to downloaded repos.' )
     parser.add_argument( '-n', '--name', action='store',
-        help='Change the name on commits to downloaded repos (implies -x).' )
+        help='Change the name on commits to downloaded repos.' )
     parser.add_argument( '-d', '--db', action='store_true',
         help='Store metadata in DB from config.' )
+    parser.add_argument( '--filter', action='store',
+        help='Make partial clones with the given git filter (e.g. blob:none).' )
+    parser.add_argument( '--depth', type=int,
+        help='Make shallow clones with only this many recent commits ' +
+            '(default: shallow_depth from the config, if set).' )
+    parser.add_argument( '-j', '--jobs', type=int,
+        help='Number of repos to clone/fetch at once (default: jobs from ' +
+            'the config, or 8).' )
 
     args = parser.parse_args()
 
@@ -472,18 +1305,43 @@ if '__main__' == __name__:
     # Load auth config.
     config = ConfigParser()
     config.read( args.config )
-    username = config.get( 'auth', 'username' )
-    api_token = config.get( 'auth', 'token' )
-    db_path = config.get( 'options', 'db_path' )
-    skip = config.get( 'options', 'skip' )
+    # Read everything out once into plain dicts.
+    cfg = {section: dict( config.items( section ) )
+        for section in config.sections()}
+    username = cfg['auth']['username']
+    api_token = cfg['auth']['token']
+    db_path = cfg['options'].get( 'db_path' )
+    skip = cfg['options'].get( 'skip', '' )
     notifier = Notifier(
-        config.get( 'notify', 'smtp_host' ),
-        config.get( 'notify', 'smtp_to' ),
-        config.get( 'notify', 'smtp_from' ) )
-    git = GitHub( username, api_token, args.topic, args.max_size, skip )
+        cfg['notify']['smtp_host'],
+        cfg['notify']['smtp_to'],
+        cfg['notify']['smtp_from'] )
+    repo_dir = cfg['options']['repo_dir']
+    if not args.jobs:
+        args.jobs = int( cfg['options'].get( 'jobs', 8 ) )
+    if not args.depth and cfg['options'].get( 'shallow_depth' ):
+        args.depth = int( cfg['options']['shallow_depth'] )
+    # API responses are per-account, not part of the backup, so cache them
+    # with the user's other caches unless told otherwise. An empty value
+    # counts as unset, like shallow_depth.
+    cache_dir = cfg['options'].get( 'cache_dir' ) or os.path.join(
+        os.environ.get( 'XDG_CACHE_HOME', os.path.expanduser( '~/.cache' ) ),
+        'gitbacker' )
+    git = GitHub( username, api_token, args.topic, args.max_size, skip,
+        etag_path=os.path.join(
+            cache_dir, 'etags-{}.json'.format( username ) ) )
 
     if args.db:
-        with sqlite3.connect( db_path ) as db_conn:
+        # Backup workers share the connection under LocalRepo's lock.
+        with sqlite3.connect( db_path, check_same_thread=False ) as db_conn:
+
+            # WAL and NORMAL sync only fsync at checkpoints rather than on
+            # every commit, which is safe enough for metadata we can rebuild.
+            db_conn.execute( 'PRAGMA journal_mode=WAL' )
+            db_conn.execute( 'PRAGMA synchronous=NORMAL' )
+            db_conn.execute( 'PRAGMA busy_timeout=5000' )
+            db_conn.execute( 'PRAGMA temp_store=MEMORY' )
+            db_conn.execute( 'PRAGMA cache_size=-20000' )
 
             # Setup the database.
             cur = db_conn.cursor()
@@ -494,12 +1352,26 @@ if '__main__' == __name__:
                 repo_id TEXT NOT NULL,
                 topics TEXT NOT NULL )
             ''' )
+            # One row per repo, so metadata can be upserted. Older DBs have
+            # a row per backup, so keep only the newest of those first.
+            cur.execute( '''SELECT 1 FROM sqlite_master
+                WHERE type = 'index' AND name = 'repos_owner_name'
+            ''' )
+            if not cur.fetchone():
+                cur.execute( '''DELETE FROM repos WHERE id NOT IN (
+                    SELECT MAX( id ) FROM repos GROUP BY owner, name )
+                ''' )
+                cur.execute( '''CREATE UNIQUE INDEX repos_owner_name
+                    ON repos( owner, name )
+                ''' )
             db_conn.commit()
 
-            local = LocalRepo( config.get( 'options', 'repo_dir' ), db_conn )
+            local = LocalRepo( repo_dir, db_conn,
+                clone_filter=args.filter, clone_depth=args.depth )
             backup_all( git, local, username, args, notifier )
     else:
         # Don't use a DB connection.
-        local = LocalRepo( config.get( 'options', 'repo_dir' ), None )
+        local = LocalRepo( repo_dir, None,
+            clone_filter=args.filter, clone_depth=args.depth )
         backup_all( git, local, username, args, notifier )
 